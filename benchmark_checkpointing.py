@@ -0,0 +1,110 @@
+import argparse
+import itertools
+import time
+from unittest import mock
+
+import torch
+
+from src import model as model_module
+from src.model import label_gcnn
+
+
+def saved_activation_bytes(model, v, a, hot_enc):
+    """
+    Bytes of the tensors autograd keeps alive between the forward and the backward pass of one step,
+    including the inputs that checkpoint keeps for the recomputation.
+    """
+    saved = {}
+
+    def pack(tensor):
+        saved[id(tensor)] = tensor.numel() * tensor.element_size()
+        return tensor
+
+    def counted_checkpoint(function, *args, **kwargs):
+        # depending on the torch version, non-reentrant checkpoint holds on to its inputs without
+        # saved_tensors_hooks; counting them here by id includes them once either way
+        for arg in args:
+            if torch.is_tensor(arg):
+                pack(arg)
+        return checkpoint(function, *args, **kwargs)
+
+    checkpoint = model_module.checkpoint
+    with mock.patch.object(model_module, 'checkpoint', counted_checkpoint), \
+            torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        out, _ = model(v, a, hot_enc)
+    out.sum().backward()
+    return sum(saved.values())
+
+
+def cpu_peak_bytes(model, v, a, hot_enc):
+    """
+    Peak CPU memory allocated during one step on top of the memory allocated before it, from the
+    allocation events recorded by the profiler.
+    """
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        out, _ = model(v, a, hot_enc)
+        out.sum().backward()
+    allocations = sorted((event for event in prof.profiler.kineto_results.events() if event.name() == '[memory]'),
+                         key=lambda event: event.start_ns())
+    return max(itertools.accumulate(event.nbytes() for event in allocations), default=0)
+
+
+def step_time(model, v, a, hot_enc, steps):
+    for step in range(steps + 1):
+        if step == 1:
+            # the first step is a warm-up
+            if v.is_cuda:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        out, _ = model(v, a, hot_enc)
+        out.sum().backward()
+    if v.is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps
+
+
+def benchmark(n_layer, checkpoint_layers, args, device):
+    torch.manual_seed(0)
+    model = label_gcnn(n_layer=n_layer, input_feat=2, output_feat=5, seq_len=args.obs_seq_len,
+                       pred_seq_len=args.pred_seq_len, kernel_size=args.kernel_size, hot_enc_length=args.n_class,
+                       checkpoint_layers=checkpoint_layers).to(device)
+    model.train()
+    v = torch.randn(1, 2, args.obs_seq_len, args.nodes, device=device)
+    a = torch.randn(args.obs_seq_len, args.nodes, args.nodes, device=device)
+    hot_enc = torch.eye(args.n_class, device=device)[torch.randint(0, args.n_class, (args.nodes,))][None]
+
+    saved = saved_activation_bytes(model, v, a, hot_enc)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+        seconds = step_time(model, v, a, hot_enc, args.steps)
+        peak = torch.cuda.max_memory_allocated()
+    else:
+        seconds = step_time(model, v, a, hot_enc, args.steps)
+        peak = cpu_peak_bytes(model, v, a, hot_enc)
+    return saved, peak, seconds
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_layers', type=str, default='1,2,4,8,16', help='comma separated layer counts to benchmark')
+    parser.add_argument('--obs_seq_len', type=int, default=8, help='length of the observed trajectory')
+    parser.add_argument('--pred_seq_len', type=int, default=12, help='length of the trajectory to be predicted')
+    parser.add_argument('--kernel_size', type=int, default=3, help='graph convolving kernel size')
+    parser.add_argument('--nodes', type=int, default=64, help='number of graph nodes')
+    parser.add_argument('--n_class', type=int, default=6, help='number of node classes')
+    parser.add_argument('--steps', type=int, default=20, help='timed training steps per configuration')
+
+    args = parser.parse_args()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    # on CUDA the peak includes the parameters and inputs, on CPU it is the peak on top of them
+    print('n_layer | checkpoint | saved activations (MB) | peak memory (MB) | step time (ms)')
+    for n_layer in [int(n) for n in args.n_layers.split(',')]:
+        results = {}
+        for checkpoint_layers in (None, 'all'):
+            saved, peak, seconds = benchmark(n_layer, checkpoint_layers, args, device)
+            results[checkpoint_layers] = seconds
+            print('%7d | %10s | %22.2f | %16.2f | %13.2f' % (
+                n_layer, checkpoint_layers or 'none', saved / 2 ** 20, peak / 2 ** 20, seconds * 1000))
+        print('step time overhead: %.1f%%' % (100 * (results['all'] / results[None] - 1)))
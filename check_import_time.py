@@ -0,0 +1,57 @@
+import argparse
+import os
+import subprocess
+import sys
+
+# dependencies the inference runtime must not import
+HEAVY_MODULES = ['networkx', 'tqdm', 'scipy', 'matplotlib', 'pandas']
+
+_PROBE = '''
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+print(' '.join(m for m in {heavy} if m in sys.modules))
+'''
+
+
+def cold_import_time(module, repeat):
+    """
+    Best time over repeat fresh interpreters to import module, and the heavy modules it pulled in.
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    times, heavy = [], set()
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', _PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                             cwd=root, check=True, capture_output=True, text=True).stdout.split('\n')
+        times.append(float(out[0]))
+        heavy.update(out[1].split())
+    return min(times), sorted(heavy)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget', type=float, default=0.5, help='allowed import time of the inference runtime on top of torch, in seconds')
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per measurement')
+
+    args = parser.parse_args()
+
+    # warm the file system cache so that the first measurement is not slower
+    cold_import_time('src.inference', 1)
+    torch_time, torch_heavy = cold_import_time('torch', args.repeat)
+    runtime_time, heavy = cold_import_time('src.inference', args.repeat)
+    # only the modules the runtime adds on top of torch count
+    heavy = [m for m in heavy if m not in torch_heavy]
+    overhead = runtime_time - torch_time
+    print('import torch: %.3f s, import src.inference: %.3f s, overhead: %.3f s (budget %.3f s)' % (
+        torch_time, runtime_time, overhead, args.budget))
+
+    failed = False
+    if heavy:
+        print('FAIL: src.inference imports', ', '.join(heavy))
+        failed = True
+    if overhead > args.budget:
+        print('FAIL: import overhead over budget')
+        failed = True
+    sys.exit(1 if failed else 0)
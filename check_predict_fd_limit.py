@@ -0,0 +1,58 @@
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+import torch
+
+from src.model import label_gcnn
+
+LABELS = ["Biker", "Pedestrian", "Car", "Bus", "Skater", "Cart"]
+
+
+def save_untrained_checkpoint(path):
+    """
+    Checkpoint of an untrained 2D model in the format of train_2D3D.py --checkpoint.
+    """
+    model_args = dict(n_layer=1, input_feat=2, output_feat=5, seq_len=8, pred_seq_len=12, kernel_size=3,
+                      hot_enc_length=len(LABELS))
+    torch.save({'model_args': model_args, 'state_dict': label_gcnn(**model_args).state_dict(), 'labels': LABELS,
+                'scaling_factor': 10, 'adjacency': 'distance', 'skeleton_blend': 0.5}, path)
+
+
+def limit_open_files(n):
+    def preexec():
+        resource.setrlimit(resource.RLIMIT_NOFILE, (n, resource.getrlimit(resource.RLIMIT_NOFILE)[1]))
+    return preexec
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scene_dir', type=str, default=os.path.join('data', 'stanfordProcessed', 'train'))
+    parser.add_argument('--open_files', type=int, default=1024, help='soft limit of open file descriptors of the run')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds before the run counts as hung')
+
+    args = parser.parse_args()
+
+    # predict_scenes.py with its default --batch_size and --workers under a common default fd limit; a part sent
+    # back from a worker as torch tensors needs an open fd per tensor and deadlocks the pool
+    root = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        checkpoint = os.path.join(tmp_dir, 'model.pt')
+        save_untrained_checkpoint(checkpoint)
+        out_dir = os.path.join(tmp_dir, 'out')
+        try:
+            result = subprocess.run([sys.executable, 'predict_scenes.py', checkpoint, args.scene_dir, out_dir,
+                                     '--device', 'cpu'], cwd=root, timeout=args.timeout,
+                                    preexec_fn=limit_open_files(args.open_files))
+        except subprocess.TimeoutExpired:
+            print('FAIL: predict_scenes.py hung with', args.open_files, 'open files')
+            sys.exit(1)
+
+        scenes = sorted(os.listdir(out_dir)) if os.path.isdir(out_dir) else []
+        done = [scene for scene in scenes if os.path.exists(os.path.join(out_dir, scene, '_SUCCESS'))]
+        print(len(done), 'of', len(os.listdir(args.scene_dir)), 'scenes predicted with', args.open_files, 'open files')
+        sys.exit(0 if result.returncode == 0 and len(done) == len(os.listdir(args.scene_dir)) else 1)
@@ -0,0 +1,31 @@
+import argparse
+import os
+
+from src.scene_format import parse_scene, write_scene
+
+
+def convert(src_dir, out_dir, delim='space'):
+    """
+    Convert every text scene file in src_dir into a memory-mappable scene directory in out_dir.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    for name in sorted(os.listdir(src_dir)):
+        path = os.path.join(src_dir, name)
+        if not os.path.isfile(path):
+            continue
+        scene = parse_scene(path, delim)
+        scene_dir = os.path.join(out_dir, os.path.splitext(name)[0])
+        write_scene(scene, scene_dir)
+        print(path, '->', scene_dir, '(%d rows, %d frames)' % (len(scene.frame), len(scene.frame_ids)))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('src_dir', type=str, help='directory of text scene files, e.g. data/stanfordProcessed/train')
+    parser.add_argument('out_dir', type=str, help='directory to write the converted scenes to')
+    parser.add_argument('--delim', type=str, default='space', help='delimiter of the text scene files')
+
+    args = parser.parse_args()
+
+    convert(args.src_dir, args.out_dir, args.delim)
@@ -0,0 +1,24 @@
+import argparse
+
+import numpy as np
+
+from src.inference import load_checkpoint, predict_batches, scene_windows, stack_windows, window_starts
+from src.scene_format import load_scene
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checkpoint', type=str, help='model checkpoint saved by train_2D3D.py --checkpoint')
+    parser.add_argument('scene', type=str, help='text scene file or converted scene directory')
+    parser.add_argument('out', type=str, help='npz file to write the frame, agent, pred and pos columns to')
+    parser.add_argument('--skip', type=int, default=1, help='number of frames between window starts')
+    parser.add_argument('--min_ped', type=int, default=1, help='windows need more agents than this')
+    parser.add_argument('--delim', type=str, default='space', help='delimiter of the text scene file')
+    parser.add_argument('--device', type=str, default='cpu')
+
+    args = parser.parse_args()
+
+    model, config = load_checkpoint(args.checkpoint, args.device)
+    scene = load_scene(args.scene, args.delim)
+    windows = scene_windows(scene, window_starts(scene, config['obs_len'], args.skip), config, args.min_ped)
+    np.savez(args.out, **predict_batches(model, stack_windows(windows), config, args.device))
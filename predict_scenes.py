@@ -0,0 +1,180 @@
+import argparse
+import collections
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+
+from src.inference import load_checkpoint, predict_batches, scene_windows, stack_windows, window_starts
+from src.scene_format import is_scene_dir, load_scene, open_scene, write_scene
+
+DONE_FILE = '_SUCCESS'
+MANIFEST_FILE = '_MANIFEST.json'
+
+# per worker process state, set by _init_worker
+_config = None
+_scene_cache = {}
+
+
+def _init_worker(config):
+    global _config
+    _config = config
+
+
+def _cached_scene(path):
+    # the parts of one scene are dispatched one after another, so keep only the last scene; scenes are
+    # converted scene directories, so loading one only memory-maps its columns
+    if path not in _scene_cache:
+        _scene_cache.clear()
+        _scene_cache[path] = load_scene(path, _config['delim'])
+    return _scene_cache[path]
+
+
+def convert_scene(task):
+    """
+    Parse a text scene once into the binary scene format, in a worker process. The workers building
+    its parts then memory-map it instead of each parsing the text again.
+    """
+    path, scene_dir = task
+    write_scene(load_scene(path, _config['delim']), scene_dir)
+    return scene_dir
+
+
+def build_part(task):
+    """
+    Parse the windows of one output part and convert them into graphs, in a worker process. The part is
+    returned as NumPy batches; the tensors are only built in the main process.
+    """
+    path, part, starts = task
+    return path, part, stack_windows(scene_windows(_cached_scene(path), starts, _config, _config['min_ped']))
+
+
+def write_part(path, columns):
+    # written under a temporary name and renamed, so an interrupted run never leaves a partial part
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **columns)
+    os.replace(tmp_path, path)
+
+
+def part_path(scene_out, part):
+    return os.path.join(scene_out, 'part-%05d.npz' % part)
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def prepare_scene_out(scene_out, manifest, overwrite):
+    """
+    Check that the existing output of a scene was written with the same checkpoint and windowing
+    arguments, since resuming with others would mix parts of different windows.
+    Returns:
+    - True if the scene is already fully predicted
+    """
+    manifest_path = os.path.join(scene_out, MANIFEST_FILE)
+    if os.path.isdir(scene_out) and os.listdir(scene_out):
+        previous = None
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                previous = json.load(f)
+        if previous == manifest:
+            return os.path.exists(os.path.join(scene_out, DONE_FILE))
+        if not overwrite:
+            raise RuntimeError('%s was written with %s, not %s; use another out_dir or --overwrite'
+                               % (scene_out, previous, manifest))
+        print(scene_out, '- arguments changed, predicting again')
+        for name in os.listdir(scene_out):
+            os.remove(os.path.join(scene_out, name))
+
+    os.makedirs(scene_out, exist_ok=True)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return False
+
+
+def run(args):
+    device = torch.device(args.device)
+    model, config = load_checkpoint(args.checkpoint, device)
+    config.update(delim=args.delim, min_ped=args.min_ped)
+    manifest = {'checkpoint': os.path.abspath(args.checkpoint), 'checkpoint_sha256': file_sha256(args.checkpoint),
+                'batch_size': args.batch_size, 'skip': args.skip, 'min_ped': args.min_ped,
+                'obs_len': config['obs_len']}
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    scenes = []
+    for name in sorted(os.listdir(args.scene_dir)):
+        path = os.path.join(args.scene_dir, name)
+        scene_out = os.path.join(args.out_dir, os.path.splitext(name)[0])
+        if prepare_scene_out(scene_out, manifest, args.overwrite):
+            print(path, '- already predicted')
+            continue
+        scenes.append((path, scene_out))
+
+    with tempfile.TemporaryDirectory(prefix='_scenes', dir=args.out_dir) as tmp_dir, \
+            multiprocessing.Pool(args.workers, initializer=_init_worker, initargs=(config,)) as pool:
+        conversions = {}
+        for i, (path, scene_out) in enumerate(scenes):
+            # text scenes are converted by the workers, a few scenes ahead of the one being predicted
+            for ahead_path, _ in scenes[i:i + args.workers + 1]:
+                if ahead_path not in conversions and not is_scene_dir(ahead_path):
+                    task = (ahead_path, os.path.join(tmp_dir, os.path.basename(ahead_path)))
+                    conversions[ahead_path] = pool.apply_async(convert_scene, (task,))
+            scene_dir = conversions.pop(path).get() if path in conversions else path
+
+            starts = window_starts(open_scene(scene_dir), config['obs_len'], args.skip)
+            n_parts = int(math.ceil(len(starts) / args.batch_size))
+            tasks = [(scene_dir, part, starts[part * args.batch_size:(part + 1) * args.batch_size])
+                     for part in range(n_parts) if not os.path.exists(part_path(scene_out, part))]
+            print(path, '-', len(starts), 'windows,', len(tasks), 'of', n_parts, 'parts to predict')
+
+            # keep a bounded number of parts in flight so memory stays flat for any archive size
+            pending = collections.deque()
+            tasks = iter(tasks)
+            while True:
+                while len(pending) < 2 * args.workers:
+                    task = next(tasks, None)
+                    if task is None:
+                        break
+                    pending.append(pool.apply_async(build_part, (task,)))
+                if not pending:
+                    break
+                _, part, batches = pending.popleft().get()
+                write_part(part_path(scene_out, part), predict_batches(model, batches, config, device))
+
+            missing = [part for part in range(n_parts) if not os.path.exists(part_path(scene_out, part))]
+            if missing:
+                raise RuntimeError('%s is missing parts %s' % (scene_out, missing))
+            open(os.path.join(scene_out, DONE_FILE), 'w').close()
+            if scene_dir != path:
+                shutil.rmtree(scene_dir)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checkpoint', type=str, help='model checkpoint saved by train_2D3D.py --checkpoint')
+    parser.add_argument('scene_dir', type=str, help='directory of text scene files or converted scene directories')
+    parser.add_argument('out_dir', type=str, help='directory to write the predictions to, one directory per scene')
+    parser.add_argument('--batch_size', type=int, default=512, help='windows per part, the unit of batching and resuming')
+    parser.add_argument('--workers', type=int, default=4, help='worker processes parsing scenes and building graphs')
+    parser.add_argument('--skip', type=int, default=1, help='number of frames between window starts')
+    parser.add_argument('--min_ped', type=int, default=1, help='windows need more agents than this')
+    parser.add_argument('--delim', type=str, default='space', help='delimiter of the text scene files')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='predict again scenes whose output was written with another checkpoint or arguments')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+    args = parser.parse_args()
+
+    run(args)
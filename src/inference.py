@@ -0,0 +1,155 @@
+"""
+Inference runtime. It imports only torch and NumPy (no networkx, tqdm or training code), so that
+short-lived prediction processes start fast; check_import_time.py guards the import budget.
+"""
+import collections
+
+import numpy as np
+import torch
+
+from src.model import label_gcnn
+from src.utils import (inverse_distance_graph, normalized_laplacian, one_hot_encoding, seq_to_skeleton_graph,
+                       skeleton_adjacency, spatial_tiles)
+
+
+def load_checkpoint(path, device='cpu'):
+    """
+    Rebuild the model saved by train_2D3D.py --checkpoint.
+    Returns:
+    - The model in eval mode on device, and the config of its input windows
+    """
+    checkpoint = torch.load(path, map_location='cpu')
+    model = label_gcnn(**checkpoint['model_args'])
+    model.load_state_dict(checkpoint['state_dict'])
+    model.to(device).eval()
+
+    config = {'obs_len': checkpoint['model_args']['seq_len'], 'pred_len': checkpoint['model_args']['pred_seq_len'],
+              'dim': checkpoint['model_args']['input_feat'], 'labels': checkpoint['labels'],
+              'scaling_factor': checkpoint['scaling_factor'],
+              'adjacency': checkpoint.get('adjacency', 'distance'),
+              'skeleton_blend': checkpoint.get('skeleton_blend', 0.5),
+              'max_nodes': checkpoint.get('max_nodes'), 'tile_mode': checkpoint.get('tile_mode', 'grid'),
+              'tile_halo': checkpoint.get('tile_halo', 1.0)}
+    return model, config
+
+
+def window_starts(scene, obs_len, skip=1):
+    return range(0, len(scene.frame_ids) - obs_len + 1, skip)
+
+
+def observed_window(scene, idx, obs_len, sf):
+    """
+    Agents observed in every frame of the window starting at frame index idx
+    Returns:
+    - agent ids, absolute and relative trajectories in :math:`(nodes, node_dim, obs_len)` format,
+        and label names of the agents
+    """
+    frames = scene.frame_ids
+    row_start, row_end = scene.frame_offsets[idx], scene.frame_offsets[idx + obs_len]
+    curr_frame = scene.frame[row_start:row_end]
+    curr_agent = scene.agent[row_start:row_end]
+    curr_coord = scene.coord[row_start:row_end]
+    curr_label = scene.label[row_start:row_end]
+
+    agents, seq, labels = [], [], []
+    for agent_id in np.unique(curr_agent):
+        agent_rows = curr_agent == agent_id
+        agent_frames = curr_frame[agent_rows]
+        if len(agent_frames) != obs_len or \
+                np.searchsorted(frames, agent_frames[-1]) - np.searchsorted(frames, agent_frames[0]) + 1 != obs_len:
+            continue
+        agents.append(agent_id)
+        seq.append(np.transpose(np.round(np.asarray(curr_coord[agent_rows], dtype=float), decimals=4)) / sf)
+        labels.append(scene.label_names[curr_label[agent_rows][0]])
+
+    seq = np.asarray(seq, dtype=float).reshape(len(agents), scene.coord.shape[1], obs_len)
+    seq_rel = np.zeros(seq.shape)
+    seq_rel[:, :, 1:] = seq[:, :, 1:] - seq[:, :, :-1]
+    return np.asarray(agents, dtype=np.int64), seq, seq_rel, labels
+
+
+def window_graph(seq_rel, labels, config):
+    """
+    Graph of one observed window for the adjacency the model was trained with.
+    """
+    seq_rel = torch.from_numpy(seq_rel).type(torch.float)
+    if config['adjacency'] == 'distance':
+        return inverse_distance_graph(seq_rel)
+    joints = [config['labels'].index(label) for label in labels]
+    skeleton = skeleton_adjacency(config['labels'])[np.ix_(joints, joints)]
+    if config['adjacency'] == 'skeleton_blend':
+        return seq_to_skeleton_graph(seq_rel, skeleton, config['skeleton_blend'])
+    a_ = torch.from_numpy(normalized_laplacian(skeleton)).type(torch.float)
+    return seq_rel.permute(2, 0, 1), a_.expand(seq_rel.shape[2], len(joints), len(joints))
+
+
+def scene_windows(scene, starts, config, min_ped=1):
+    """
+    Observed windows of a scene with their graphs as NumPy arrays, for stack_windows. Windows with more
+    agents than the max_nodes the model was trained with are split into the same spatial tiles as in training.
+    """
+    encoding = one_hot_encoding(config['labels'])
+    windows = []
+    for idx in starts:
+        agents, seq, seq_rel, labels = observed_window(scene, idx, config['obs_len'], config['scaling_factor'])
+        if len(agents) <= min_ped:
+            continue
+        if config['max_nodes'] is not None and len(agents) > config['max_nodes']:
+            tiles = spatial_tiles(seq[:, :, -1], config['max_nodes'], config['tile_mode'], config['tile_halo'],
+                                  min_ped + 1)
+        else:
+            tiles = [(np.arange(len(agents)), np.ones(len(agents), dtype=bool))]
+        for node_idx, core in tiles:
+            tile_labels = [labels[i] for i in node_idx]
+            v_, a_ = window_graph(seq_rel[node_idx], tile_labels, config)
+            windows.append({
+                'frame': scene.frame_ids[idx + config['obs_len'] - 1],
+                'agent': agents[node_idx],
+                'last_pos': seq[node_idx, :, -1],
+                'core': core,
+                'V': v_.numpy(), 'A': a_.numpy(),
+                'classes': np.asarray([encoding[label] for label in tile_labels], dtype=np.float32),
+            })
+    return windows
+
+
+def stack_windows(windows):
+    """
+    Stack the windows with the same number of agents into one batch each. The batches hold only NumPy
+    arrays, so worker processes can return them without sharing a file descriptor per tensor.
+    Returns:
+        List of dicts of the window fields, each stacked along a leading batch dimension
+    """
+    by_size = collections.defaultdict(list)
+    for window in windows:
+        by_size[len(window['agent'])].append(window)
+    return [{name: np.stack([w[name] for w in group]) for name in group[0]} for group in by_size.values()]
+
+
+@torch.inference_mode()
+def predict_batches(model, batches, config, device='cpu'):
+    """
+    Predict the batches of stack_windows.
+    Returns:
+        Dict of the output columns keyed by (frame, agent), for the core agents of every window: the last
+        observed frame, the agent id, the raw model output in :math:`(rows, pred_seq_len, output_feat)` format
+        and the absolute predicted position in the scene units in :math:`(rows, pred_seq_len, node_dim)` format
+    """
+    columns = collections.defaultdict(list)
+    for batch in batches:
+        v = torch.from_numpy(batch['V']).permute(0, 3, 1, 2).to(device)
+        a = torch.from_numpy(batch['A']).to(device)
+        classes = torch.from_numpy(batch['classes']).to(device)
+        V_pred, _ = model(v, a, classes)
+        V_pred = V_pred.permute(0, 3, 2, 1).cpu()  # (batch, nodes, pred_seq_len, output_feat)
+
+        core = batch['core']
+        dim = batch['last_pos'].shape[2]
+        pos = torch.cumsum(V_pred[..., :dim], dim=2).numpy() + batch['last_pos'][:, :, None, :]
+        pos = pos * config['scaling_factor']
+        columns['frame'].append(np.broadcast_to(batch['frame'][:, None], core.shape)[core].astype(np.int64))
+        columns['agent'].append(batch['agent'][core])
+        columns['pred'].append(V_pred.numpy()[core].astype(np.float32))
+        columns['pos'].append(pos[core].astype(np.float32))
+
+    return {name: np.concatenate(column) for name, column in columns.items()}
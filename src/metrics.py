@@ -145,3 +145,70 @@ def skeleton_loss(V_pred, V_trgt, obs_classes, class_weights, labels):
     for i in range(len(counts)):
         weight_sum += (counts[i] * class_weights[i])
     return torch.mul(result, (weight_sum / sum(counts)))
+
+
+# bounds keeping the Cholesky factor of bivariate_samples finite and positive definite in float32
+LOG_SIGMA_BOUND = 20.
+CORR_EPS = 1e-4
+
+
+def bivariate_samples(V_pred, k):
+    """
+    Draw k samples per node and time step from the estimated bi-variant distributions in one batched call
+    Args:
+        V_pred: Predicted distribution parameters (mux, muy, log sx, log sy, corr before tanh) in :math:`(pred_seq_len, nodes, 5)` format
+        k: Number of samples
+    Returns:
+        Sampled relative trajectories in :math:`(k, pred_seq_len, nodes, 2)` format
+    """
+    sx = torch.exp(torch.clamp(V_pred[..., 2], -LOG_SIGMA_BOUND, LOG_SIGMA_BOUND))
+    sy = torch.exp(torch.clamp(V_pred[..., 3], -LOG_SIGMA_BOUND, LOG_SIGMA_BOUND))
+    # tanh saturates to exactly +-1 in float32, which would zero the second diagonal entry
+    corr = torch.clamp(torch.tanh(V_pred[..., 4]), -1 + CORR_EPS, 1 - CORR_EPS)
+
+    # Cholesky factor of [[sx^2, corr*sx*sy], [corr*sx*sy, sy^2]]
+    scale_tril = torch.zeros(V_pred.shape[:-1] + (2, 2), dtype=V_pred.dtype, device=V_pred.device)
+    scale_tril[..., 0, 0] = sx
+    scale_tril[..., 1, 0] = corr * sy
+    scale_tril[..., 1, 1] = sy * torch.sqrt(1 - corr ** 2)
+
+    mvnormal = torch.distributions.MultivariateNormal(V_pred[..., :2], scale_tril=scale_tril)
+    return mvnormal.sample((k,))
+
+
+def best_of_k(V_pred, init_pos, target, k=20):
+    """
+    Best-of-k displacement errors of the sampled trajectories, per node. Nodes with non-finite predicted
+    parameters cannot be sampled and are left out.
+    Args:
+        V_pred: Predicted distribution parameters in :math:`(pred_seq_len, nodes, 5)` format
+        init_pos: Last observed absolute position in :math:`(nodes, 2)` format
+        target: Ground truth absolute trajectory in :math:`(pred_seq_len, nodes, 2)` format
+        k: Number of samples
+    Returns:
+        minADE and minFDE over the k samples of the kept nodes, each in :math:`(kept nodes,)` format,
+        and the mask of the kept nodes in :math:`(nodes,)` format
+    """
+    valid = torch.isfinite(V_pred).all(dim=-1).all(dim=0)
+    samples = torch.cumsum(bivariate_samples(V_pred[:, valid], k), dim=1) + init_pos[valid]
+    error = torch.norm(samples - target[:, valid], dim=-1)  # (k, pred_seq_len, kept nodes)
+    min_ade = error.mean(dim=1).min(dim=0)[0]
+    min_fde = error[:, -1].min(dim=0)[0]
+    return min_ade, min_fde, valid
+
+
+def class_mean(values, obs_classes, labels):
+    """
+    Average a per-node metric over the nodes of every class
+    Args:
+        values: Per-node metric in :math:`(nodes,)` format
+        obs_classes: The one-hot embedding of the nodes in :math:`(nodes, len(labels))` format
+        labels: All the label categories of the trajectory
+    Returns:
+        Dict from label to the class average, for the classes present in obs_classes
+    """
+    # one_hot_encoding puts labels[i] at position len(labels) - 1 - i
+    class_idx = len(labels) - 1 - torch.argmax(obs_classes, dim=1)
+    sums = torch.zeros(len(labels), dtype=values.dtype, device=values.device).index_add_(0, class_idx, values)
+    counts = torch.bincount(class_idx, minlength=len(labels))
+    return {labels[i]: (sums[i] / counts[i]).item() for i in range(len(labels)) if counts[i] > 0}
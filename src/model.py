@@ -1,5 +1,27 @@
+from contextlib import contextmanager
+
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+
+@contextmanager
+def frozen_batch_norm_stats(module):
+    """
+    Keep the running statistics of every batch norm in module unchanged, so that the
+    recomputation of a checkpointed block does not count its batch twice.
+    """
+    saved = []
+    for m in module.modules():
+        if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats:
+            saved.append((m, m.momentum, m.num_batches_tracked.clone()))
+            m.momentum = 0.
+    try:
+        yield
+    finally:
+        for m, momentum, num_batches_tracked in saved:
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(num_batches_tracked)
 
 
 class ConvTemporalGraphical(nn.Module):
@@ -20,10 +42,10 @@ class ConvTemporalGraphical(nn.Module):
             Default: ``True``
     Inputs:
         - Input[0]: Input graph sequence in :math:`(N, in_channels, T_{in}, V)` format
-        - Input[1]: Input graph adjacency matrix in :math:`(K, V, V)` format
+        - Input[1]: Input graph adjacency matrix in :math:`(K, V, V)` format, or :math:`(N, K, V, V)` for one adjacency per sample
     Returns:
         - Output[0]: Output graph sequence in :math:`(N, out_channels, T_{out}, V)` format
-        - Output[1]: Graph adjacency matrix for output data in :math:`(K, V, V)` format
+        - Output[1]: Graph adjacency matrix for output data in :math:`(K, V, V)` or :math:`(N, K, V, V)` format
         where
             :math:`N` is a batch size,
             :math:`K` is the spatial kernel size, as :math:`K == kernel_size[1]`,
@@ -52,9 +74,12 @@ class ConvTemporalGraphical(nn.Module):
             bias=bias)
 
     def forward(self, x, A):
-        assert A.size(0) == self.kernel_size
+        assert A.size(-3) == self.kernel_size
         x = self.conv(x)
-        x = torch.einsum('nctv,tvw->nctw', (x, A))
+        if A.dim() == 4:
+            x = torch.einsum('nctv,ntvw->nctw', (x, A))
+        else:
+            x = torch.einsum('nctv,tvw->nctw', (x, A))
         return x.contiguous(), A
 
 
@@ -70,10 +95,10 @@ class seq_gcn(nn.Module):
         residual (bool, optional): If ``True``, applies a residual mechanism. Default: ``True``
     Inputs:
         - Input[0]: Input graph sequence in :math:`(N, in_channels, T_{in}, V)` format
-        - Input[1]: Input graph adjacency matrix in :math:`(K, V, V)` format
+        - Input[1]: Input graph adjacency matrix in :math:`(K, V, V)` format, or :math:`(N, K, V, V)` for one adjacency per sample
     Returns:
         - Output[0]: Output graph sequence in :math:`(N, out_channels, T_{out}, V)` format
-        - Output[1]: Graph adjacency matrix for output data in :math:`(K, V, V)` format
+        - Output[1]: Graph adjacency matrix for output data in :math:`(K, V, V)` or :math:`(N, K, V, V)` format
         where
             :math:`N` is a batch size,
             :math:`K` is the spatial kernel size, as :math:`K == kernel_size[1]`,
@@ -152,19 +177,21 @@ class label_gcnn(nn.Module):
         pred_seq_len (int): Length of the trajectory to be predicted
         kernel_size (int): Size of the graph convolving kernel
         hot_enc_length (int): Number of classes in the whole sequence data for one-hot embedding 
+        checkpoint_layers (iterable or str, optional): Indices of the seq_gcn layers whose activations are
+            recomputed in the backward pass instead of kept in memory, or ``'all'``. Default: ``None``
     Inputs:
         - Input[0]: Input graph sequence in :math:`(N, input_feat, seq_len, V)` format
-        - Input[1]: Input graph adjacency matrix in :math:`(K, V, V)` format
+        - Input[1]: Input graph adjacency matrix in :math:`(K, V, V)` format, or :math:`(N, K, V, V)` for one adjacency per sample
     Returns:
         - Output[0]: Output graph sequence in :math:`(N, output_feat, pred_seq_len, V)` format
-        - Output[1]: Graph adjacency matrix for output data in :math:`(K, V, V)` format
+        - Output[1]: Graph adjacency matrix for output data in :math:`(K, V, V)` or :math:`(N, K, V, V)` format
         where
             :math:`N` is a batch size,
             :math:`K` is the spatial kernel size,
             :math:`V` is the number of graph nodes. 
     """
     def __init__(self, n_layer=1,  input_feat=2, output_feat=5,
-                 seq_len=8, pred_seq_len=2, kernel_size=3, hot_enc_length=1):
+                 seq_len=8, pred_seq_len=2, kernel_size=3, hot_enc_length=1, checkpoint_layers=None):
         super(label_gcnn, self).__init__()
 
         self.v_norm = nn.Sequential(
@@ -193,23 +220,39 @@ class label_gcnn(nn.Module):
         for j in range(1, self.n_layer):
             self.seq_gcns.append(seq_gcn(output_feat, output_feat, (kernel_size, seq_len)))
 
+        if checkpoint_layers == 'all':
+            checkpoint_layers = range(self.n_layer)
+        self.checkpoint_layers = set(checkpoint_layers or [])
+        if not self.checkpoint_layers <= set(range(self.n_layer)):
+            raise ValueError("checkpoint_layers must be in range(n_layer)")
+
         self.pred_embed = nn.Sequential(nn.Linear(seq_len, pred_seq_len, bias=True), nn.PReLU()) 
 
 
     def forward(self, v, a, hot_enc): 
+        # a batch of graphs with one adjacency per sample
+        batched = a.dim() == 4
+        if not batched:
+            a = a.unsqueeze(0)
         # normalise inputs with layers
         v = self.v_norm(v.permute(0, 1, 3, 2)).permute(0, 1, 3, 2)
-        a = self.a_norm(a.permute(1, 2, 0)).permute(2, 0, 1)
-        # generate embedding of the class labels
-        hot_enc = hot_enc.repeat(a.shape[1], 1, 1)
-        hot_enc = torch.cat((hot_enc.rot90(k=-1), hot_enc), 2)
+        a = self.a_norm(a.permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
+        # generate embedding of the class labels, pairing the labels of every two nodes
+        n_nodes = hot_enc.shape[1]
+        hot_enc = torch.cat((hot_enc.unsqueeze(2).expand(-1, -1, n_nodes, -1),
+                             hot_enc.unsqueeze(1).expand(-1, n_nodes, -1, -1)), 3)
 
         # combine class labels with adjacency matrix
-        c = self.a_lin1(hot_enc).permute(2, 0, 1)
-        a = self.a_lin2(torch.cat((a, c)).permute(1, 2, 0)).permute(2, 0, 1)
+        c = self.a_lin1(hot_enc).permute(0, 3, 1, 2)
+        a = self.a_lin2(torch.cat((a.expand(c.shape[0], -1, -1, -1), c), 1).permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
+        if not batched:
+            a = a.squeeze(0)
 
         for k in range(self.n_layer):
-            v, a = self.seq_gcns[k](v, a)
+            if k in self.checkpoint_layers and self.training and torch.is_grad_enabled():
+                v, a = self._checkpointed(self.seq_gcns[k], v, a)
+            else:
+                v, a = self.seq_gcns[k](v, a)
 
         v = v.permute(0, 1, 3, 2)
         v = self.pred_embed(v)
@@ -217,3 +260,19 @@ class label_gcnn(nn.Module):
 
 
         return v, a
+
+    @staticmethod
+    def _checkpointed(layer, v, a):
+        recompute = [False]
+
+        def run(v, a):
+            # the first call is the forward pass, later calls recompute it for the backward pass
+            if not recompute[0]:
+                recompute[0] = True
+                return layer(v, a)
+            with frozen_batch_norm_stats(layer):
+                return layer(v, a)
+
+        # preserve_rng_state replays the forward dropout mask; the in-place dropout only writes to
+        # the batch norm output inside the block, never to the checkpointed inputs
+        return checkpoint(run, v, a, use_reentrant=False, preserve_rng_state=True)
@@ -0,0 +1,145 @@
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+
+FORMAT_VERSION = 1
+META_FILE = 'meta.json'
+
+Scene = namedtuple('Scene', ['frame', 'agent', 'coord', 'label', 'label_names', 'frame_ids', 'frame_offsets'])
+Scene.__doc__ = """
+Columnar view of one scene file, rows sorted by frame (stable w.r.t. the file order).
+    frame: Frame id of every row in :math:`(R,)` format
+    agent: Agent id of every row in :math:`(R,)` format
+    coord: Coordinates of every row in :math:`(R, dim)` format, float32 unless rounding to 4 decimals needs float64
+    label: Code of the row label, indexing into ``label_names``, in :math:`(R,)` format
+    label_names: Label dictionary, list of label strings
+    frame_ids: Sorted unique frame ids in :math:`(F,)` format
+    frame_offsets: Row offset of every frame in :math:`(F + 1,)` format, the rows of
+        ``frame_ids[f]`` are ``frame_offsets[f]:frame_offsets[f + 1]``
+"""
+
+_COLUMNS = ('frame', 'agent', 'coord', 'label', 'frame_ids', 'frame_offsets')
+
+
+def _delimiter(delim):
+    if delim == 'tab':
+        return '\t'
+    if delim == 'space':
+        return ' '
+    return delim
+
+
+def _id_dtype(ids):
+    if len(ids) == 0 or (ids.min() >= np.iinfo(np.int32).min and ids.max() <= np.iinfo(np.int32).max):
+        return np.int32
+    return np.int64
+
+
+def _coord_dtype(coord):
+    # the datasets round coordinates to 4 decimals on load; float32 is used when that rounding is unchanged
+    single = coord.astype(np.float32).astype(np.float64)
+    if np.array_equal(np.round(single, decimals=4), np.round(coord, decimals=4)):
+        return np.float32
+    return np.float64
+
+
+def build_scene(frame, agent, coord, label_names, label):
+    """
+    Sort the rows by frame and build the per-frame row-offset index.
+    """
+    frame = np.asarray(frame, dtype=np.int64)
+    agent = np.asarray(agent, dtype=np.int64)
+    order = np.argsort(frame, kind='stable')
+    frame = frame[order]
+    frame_ids, counts = np.unique(frame, return_counts=True)
+    frame_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.min_scalar_type(len(frame)))
+    label_dtype = np.min_scalar_type(max(len(label_names) - 1, 0))
+    coord = np.asarray(coord, dtype=np.float64)
+
+    return Scene(frame=frame.astype(_id_dtype(frame)),
+                 agent=agent[order].astype(_id_dtype(agent)),
+                 coord=coord[order].astype(_coord_dtype(coord)),
+                 label=np.asarray(label, dtype=label_dtype)[order],
+                 label_names=list(label_names),
+                 frame_ids=frame_ids.astype(_id_dtype(frame_ids)),
+                 frame_offsets=frame_offsets)
+
+
+def parse_scene(_path, delim='space'):
+    """
+    Parse a text scene file with rows in the format <frame_id> <ped_id> <x> <y> [<z>] <label>.
+    """
+    delim = _delimiter(delim)
+    frame, agent, coord, label = [], [], [], []
+    label_codes = {}
+    with open(_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            line = line.split(delim)
+            frame.append(float(line[0]))
+            agent.append(float(line[1]))
+            coord.append([float(x) for x in line[2:-1]])
+            label.append(label_codes.setdefault(line[-1], len(label_codes)))
+
+    if not frame:
+        return build_scene(np.zeros(0), np.zeros(0), np.zeros((0, 0)), [], np.zeros(0))
+    frame, agent = np.asarray(frame), np.asarray(agent)
+    if np.any(frame != np.round(frame)) or np.any(agent != np.round(agent)):
+        raise ValueError(str(_path) + " - frame and agent ids must be integers")
+
+    return build_scene(frame, agent, coord, list(label_codes), label)
+
+
+def write_scene(scene, out_dir):
+    """
+    Write a scene as raw little-endian column files plus a ``meta.json`` header describing them.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    meta = {'version': FORMAT_VERSION, 'label_names': scene.label_names, 'columns': {}}
+    for name in _COLUMNS:
+        column = getattr(scene, name)
+        column = np.ascontiguousarray(column, dtype=column.dtype.newbyteorder('<'))
+        column.tofile(os.path.join(out_dir, name + '.bin'))
+        meta['columns'][name] = {'dtype': column.dtype.str, 'shape': list(column.shape)}
+    with open(os.path.join(out_dir, META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+
+def is_scene_dir(path):
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, META_FILE))
+
+
+def open_scene(scene_dir):
+    """
+    Open a converted scene directory; every column is a read-only ``np.memmap`` over its file.
+    """
+    with open(os.path.join(scene_dir, META_FILE)) as f:
+        meta = json.load(f)
+    if meta['version'] != FORMAT_VERSION:
+        raise ValueError(str(scene_dir) + " - unsupported scene format version " + str(meta['version']))
+
+    columns = {}
+    for name in _COLUMNS:
+        spec = meta['columns'][name]
+        shape = tuple(spec['shape'])
+        if int(np.prod(shape)) == 0:
+            # mmap cannot map an empty file
+            columns[name] = np.zeros(shape, dtype=spec['dtype'])
+        else:
+            columns[name] = np.memmap(os.path.join(scene_dir, name + '.bin'), dtype=spec['dtype'],
+                                      mode='r', shape=shape)
+
+    return Scene(label_names=meta['label_names'], **columns)
+
+
+def load_scene(path, delim='space'):
+    """
+    Load a scene from either a text file or a converted scene directory.
+    """
+    if is_scene_dir(path):
+        return open_scene(path)
+    return parse_scene(path, delim)
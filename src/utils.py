@@ -1,11 +1,12 @@
 import math
 import os
+from collections import defaultdict
 
-import networkx as nx
 import numpy as np
 import torch
-from torch.utils.data import Dataset
-from tqdm import tqdm
+from torch.utils.data import Dataset, Sampler
+
+from src.scene_format import load_scene
 
 
 def one_hot_encoding(labels):
@@ -71,6 +72,9 @@ def seq_to_graph(seq_, seq_rel, norm_lap_matr=True, node_dim=2):
             :math:`max_nodes` is the maximum number of objects in the trajectory,
             :math:`node_dim` is the feature size of each object.
     """
+    # imported here so that importing this module only costs torch and NumPy
+    import networkx as nx
+
     seq_ = seq_.squeeze()
     seq_rel = seq_rel.squeeze()
     seq_len = seq_.shape[2]
@@ -96,6 +100,110 @@ def seq_to_graph(seq_, seq_rel, norm_lap_matr=True, node_dim=2):
            torch.from_numpy(A).type(torch.float)
 
 
+def inverse_distance(step_rel):
+    """
+    Adjacency of anorm between every two nodes with ones on the diagonal, as built by seq_to_graph
+    Inputs:
+        step_rel: float32 relative positions in :math:`(..., max_nodes, node_dim)` format
+    Returns:
+    - A: Adjacency matrix in :math:`(..., max_nodes, max_nodes)` format
+    """
+    # the squared distance is summed in float32 like anorm on the float32 tensors of seq_to_graph
+    diff = step_rel[..., :, None, :2] - step_rel[..., None, :, :2]
+    norm = np.sqrt((diff[..., 0] ** 2 + diff[..., 1] ** 2).astype(float))
+    A = np.zeros(norm.shape)
+    np.divide(1., norm, out=A, where=norm > 0)
+    diag = np.arange(A.shape[-1])
+    A[..., diag, diag] = 1
+    return A
+
+
+def inverse_distance_graph(seq_rel, norm_lap_matr=True):
+    """
+    Vectorized seq_to_graph without networkx
+    Inputs:
+        seq_rel: Relative trajectory sequence in :math:`(max_nodes, node_dim, seq_len)` format
+    Returns:
+    - V: Converted graph sequence in :math:`(seq_len, max_nodes, node_dim)` format, a view of seq_rel
+    - A: Graph adjacency matrix for the graph sequence in :math:`(seq_len, max_nodes, max_nodes)` format
+    """
+    V = seq_rel.permute(2, 0, 1)
+    A = inverse_distance(V.numpy())
+    if norm_lap_matr:
+        A = normalized_laplacian(A)
+    return V, torch.from_numpy(A).type(torch.float)
+
+
+# Kinematic tree of the 25 CMU joints
+CMU_SKELETON_EDGES = [
+    ('LeftHip', 'LeftKnee'), ('LeftKnee', 'LeftFeet'), ('LeftFeet', 'LeftToe'),
+    ('RightHip', 'RightKnee'), ('RightKnee', 'RightFeet'), ('RightFeet', 'RightToe'),
+    ('LeftHip', 'Spine1'), ('RightHip', 'Spine1'), ('Spine1', 'Spine2'),
+    ('Spine2', 'Neck1'), ('Neck1', 'Neck2'), ('Neck2', 'Head'),
+    ('Spine2', 'LeftClavicle'), ('LeftClavicle', 'LeftHumerus'), ('LeftHumerus', 'LeftRadius'),
+    ('LeftRadius', 'LeftWrist'), ('LeftWrist', 'LeftHand'), ('LeftHand', 'LeftFinger'),
+    ('Spine2', 'RightClavicle'), ('RightClavicle', 'RightHumerus'), ('RightHumerus', 'RightRadius'),
+    ('RightRadius', 'RightWrist'), ('RightWrist', 'RightHand'), ('RightHand', 'RightFinger'),
+]
+
+
+def skeleton_adjacency(labels, edges=CMU_SKELETON_EDGES):
+    """
+    Fixed adjacency matrix with self loops of the skeleton, in :math:`(len(labels), len(labels))` format
+    with the joints in the order of labels.
+    """
+    A = np.eye(len(labels))
+    for j1, j2 in edges:
+        A[labels.index(j1), labels.index(j2)] = 1
+        A[labels.index(j2), labels.index(j1)] = 1
+    return A
+
+
+def normalized_laplacian(A):
+    """
+    Normalized Laplacian D^-1/2 (D - A) D^-1/2 of a stack of adjacency matrices in :math:`(..., nodes, nodes)`
+    format, matching networkx.normalized_laplacian_matrix for every matrix.
+    """
+    d = A.sum(axis=-1)
+    d_inv_sqrt = np.zeros_like(d)
+    np.divide(1., np.sqrt(d), out=d_inv_sqrt, where=d > 0)
+    L = -A.copy()
+    diag = np.arange(A.shape[-1])
+    L[..., diag, diag] += d
+    return d_inv_sqrt[..., :, None] * L * d_inv_sqrt[..., None, :]
+
+
+def seq_to_skeleton_graph(seq_rel, skeleton, blend=0.5, norm_lap_matr=True):
+    """
+    Convert the skeleton trajectory into the graph format, blending the skeleton topology with the
+    inverse distance between the joints of every skeleton edge
+    Inputs:
+        seq_rel: Relative trajectory sequence in :math:`(max_nodes, node_dim, seq_len)` format
+        skeleton: Skeleton adjacency of the nodes in :math:`(max_nodes, max_nodes)` format
+        blend: Weight of the inverse-distance term
+    Returns:
+    - V: Converted graph sequence in :math:`(seq_len, max_nodes, node_dim)` format, a view of seq_rel
+    - A: Graph adjacency matrix for the graph sequence in :math:`(seq_len, max_nodes, max_nodes)` format
+    """
+    V = seq_rel.permute(2, 0, 1)
+    seq_len, max_nodes = V.shape[0], V.shape[1]
+
+    h, k = np.nonzero(np.triu(skeleton, 1))
+    rel = V.numpy()
+    dist = np.linalg.norm(rel[:, h] - rel[:, k], axis=-1)
+    inv_dist = np.zeros_like(dist)
+    np.divide(1., dist, out=inv_dist, where=dist > 0)
+    A = np.repeat(((1 - blend) * skeleton)[None], seq_len, axis=0)
+    A[:, h, k] += blend * inv_dist
+    A[:, k, h] += blend * inv_dist
+    diag = np.arange(max_nodes)
+    A[:, diag, diag] = 1
+    if norm_lap_matr:
+        A = normalized_laplacian(A)
+
+    return V, torch.from_numpy(A).type(torch.float)
+
+
 def anorm(p1, p2):
     NORM = math.sqrt((p1[0] - p2[0]) ** 2 + (p1[1] - p2[1]) ** 2)
     if NORM == 0:
@@ -125,23 +233,72 @@ def poly_fit(traj, traj_len, threshold):
         return 0.0
 
 
-def read_file(_path, delim='\t'):
-    data = []
-    if delim == 'tab':
-        delim = '\t'
-    elif delim == 'space':
-        delim = ' '
-    with open(_path, 'r') as f:
-        for line in f:
-            line = line.strip().split(delim)
-            #if (len(line) == 5):
-            for i in range(len(line)):
-                try:
-                    line[i] = float(line[i])
-                except ValueError:
-                    line[i] = str(line[i])
-            data.append(line)
-    return np.asarray(data, dtype=object)
+def _bisect_cells(pos, idx, capacity):
+    """
+    Recursively split the nodes idx at the median of the widest axis until every cell holds at most capacity nodes.
+    """
+    if len(idx) <= capacity:
+        return [idx]
+    axis = np.argmax(pos[idx].max(axis=0) - pos[idx].min(axis=0))
+    order = idx[np.argsort(pos[idx, axis], kind='stable')]
+    half = len(order) // 2
+    return _bisect_cells(pos, order[:half], capacity) + _bisect_cells(pos, order[half:], capacity)
+
+
+def _kmeans_cells(pos, capacity, n_iter=10):
+    n_cells = int(math.ceil(len(pos) / capacity))
+    rng = np.random.RandomState(0)
+    centers = pos[rng.choice(len(pos), n_cells, replace=False)]
+    for _ in range(n_iter):
+        assign = np.argmin(((pos[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2), axis=1)
+        for c in range(n_cells):
+            if np.any(assign == c):
+                centers[c] = pos[assign == c].mean(axis=0)
+    cells = []
+    for c in range(n_cells):
+        idx = np.flatnonzero(assign == c)
+        if len(idx) > 0:
+            # k-means does not bound the cell size, so oversized cells are bisected
+            cells += _bisect_cells(pos, idx, capacity)
+    return cells
+
+
+def spatial_tiles(pos, max_nodes, mode='grid', halo=1.0, min_nodes=2):
+    """
+    Split the nodes of a crowded sequence into spatial tiles of at most max_nodes nodes
+    Inputs:
+        pos: Node positions used for the split in :math:`(num_nodes, node_dim)` format
+        max_nodes: Upper bound on the number of nodes of every tile
+        mode: 'grid' for recursive median bisection, 'kmeans' for k-means cells
+        halo: Radius around the core nodes from which context nodes are added to a tile
+        min_nodes: Minimum number of nodes of every tile
+    Returns:
+    - List of (node_idx, core) pairs, where node_idx indexes the tile nodes and the boolean
+        core marks the nodes the tile predicts for. Every node is a core node of exactly one tile.
+    """
+    capacity = max(1, max_nodes // 2)
+    all_idx = np.arange(len(pos))
+    if mode == 'grid':
+        cells = _bisect_cells(pos, all_idx, capacity)
+    elif mode == 'kmeans':
+        cells = _kmeans_cells(pos, capacity)
+    else:
+        raise ValueError("Unknown tile mode: " + str(mode))
+
+    tiles = []
+    for core_idx in cells:
+        others = np.setdiff1d(all_idx, core_idx)
+        dist = np.sqrt(((pos[others][:, None, :] - pos[core_idx][None, :, :]) ** 2).sum(axis=2)).min(axis=1)
+        order = np.argsort(dist, kind='stable')
+        n_halo = max(int(np.sum(dist <= halo)), min_nodes - len(core_idx))
+        n_halo = min(n_halo, max_nodes - len(core_idx))
+        halo_idx = others[order[:n_halo]]
+        node_idx = np.concatenate((core_idx, halo_idx))
+        core = np.zeros(len(node_idx), dtype=bool)
+        core[:len(core_idx)] = True
+        tiles.append((node_idx, core))
+
+    return tiles
 
 
 class TrajectoryDataset(Dataset):
@@ -149,11 +306,14 @@ class TrajectoryDataset(Dataset):
 
     def __init__(
             self, data_dir, obs_len=8, pred_len=8, skip=1, threshold=0.002,
-            min_ped=1, delim='space', norm_lap_matr=True, label=None, dim=2, sf=10):
+            min_ped=1, delim='space', norm_lap_matr=True, label=None, dim=2, sf=10,
+            max_nodes=None, tile_mode='grid', tile_halo=1.0,
+            adjacency='distance', skeleton_edges=CMU_SKELETON_EDGES, skeleton_blend=0.5):
         """
         Args:
         - data_dir: Directory containing dataset files in the format
-        <frame_id> <ped_id> <x> <y>
+        <frame_id> <ped_id> <x> <y> [<z>] <label>, or scene directories
+        converted by convert_scenes.py, which are memory-mapped instead of parsed
         - obs_len: Number of time-steps in input trajectories
         - pred_len: Number of time-steps in output trajectories
         - skip: Number of frames to skip while making the dataset
@@ -163,7 +323,27 @@ class TrajectoryDataset(Dataset):
         - delim: Delimiter in the dataset files
         - dim: 2D or 3D data
         - sf: scaling factor for the dataset
+        - max_nodes: Sequences with more nodes are split into spatial tiles of at most
+        max_nodes nodes; None disables tiling
+        - tile_mode: 'grid' or 'kmeans' split of crowded sequences
+        - tile_halo: Radius (after scaling by sf) of the context nodes added around each tile
+        - adjacency: 'distance' for the inverse-distance graph of every time step, 'skeleton' for
+        the fixed skeleton topology (label must name the joints), or 'skeleton_blend' for the
+        topology blended with the inverse distance on the skeleton edges
+        - skeleton_edges: Joint label pairs of the skeleton topology
+        - skeleton_blend: Weight of the distance term for the 'skeleton_blend' adjacency
         """
+        if adjacency not in ('distance', 'skeleton', 'skeleton_blend'):
+            raise ValueError("Unknown adjacency: " + str(adjacency))
+        if adjacency != 'distance':
+            missing = sorted({joint for edge in skeleton_edges for joint in edge} - set(label or []))
+            if missing:
+                raise ValueError("adjacency " + str(adjacency) + " needs a label for every skeleton joint, missing: "
+                                 + ", ".join(missing))
+        if max_nodes is not None and max_nodes <= min_ped:
+            raise ValueError("max_nodes must be larger than min_ped")
+        from tqdm import tqdm
+
         super(TrajectoryDataset, self).__init__()
         self.max_peds_in_frame = 0
         self.data_dir = data_dir
@@ -181,24 +361,29 @@ class TrajectoryDataset(Dataset):
         seq_list_rel = []
         seq_list_class = []
         loss_mask_list = []
+        core_mask_list = []
         non_linear_ped = []
         for path in all_files:
             print(path)
-            data = read_file(path, delim)
-            if (np.array_equal(data, [])):
+            scene = load_scene(path, delim)
+            if len(scene.frame) == 0:
                 print(str(path) + " - No data in file")
                 continue
-            frames = np.unique(data[:, 0]).tolist()
-            frame_data = []
-            for frame in frames:
-                frame_data.append(data[frame == data[:, 0], :])  # the same scene put together e.g.[([2990,..biker],[2990,...],[2990...car]), ([2991,..biker],[2991,...])]
+            frames = scene.frame_ids
+            frame_offsets = scene.frame_offsets
+            class_encoding = one_hot_encoding(label)
             num_sequences = int(
                 math.ceil((len(frames) - self.seq_len + 1) / skip))  # step every skip frames
             for idx in range(0, num_sequences * self.skip + 1, skip): # every seq
-                curr_seq_data = np.concatenate(
-                    frame_data[idx:idx + self.seq_len], axis=0)
-
-                peds_in_curr_seq = np.unique(curr_seq_data[:, 1]) # pedestrians in the current seq, i.e. # nodes in the current seq
+                # rows of frames idx .. idx + seq_len are contiguous, so these are views into the scene
+                row_start = frame_offsets[min(idx, len(frames))]
+                row_end = frame_offsets[min(idx + self.seq_len, len(frames))]
+                curr_frame = scene.frame[row_start:row_end]
+                curr_agent = scene.agent[row_start:row_end]
+                curr_coord = scene.coord[row_start:row_end]
+                curr_label = scene.label[row_start:row_end]
+
+                peds_in_curr_seq = np.unique(curr_agent) # pedestrians in the current seq, i.e. # nodes in the current seq
                 self.max_peds_in_frame = max(self.max_peds_in_frame, len(peds_in_curr_seq))
                 curr_seq_rel = np.zeros((len(peds_in_curr_seq), dim,
                                          self.seq_len))   
@@ -209,14 +394,12 @@ class TrajectoryDataset(Dataset):
                 num_peds_considered = 0
                 _non_linear_ped = []
                 for _, ped_id in enumerate(peds_in_curr_seq):  # every node in the seq
-                    curr_ped_seq = curr_seq_data[curr_seq_data[:, 1] ==
-                                                 ped_id, :]
-                    curr_ped_seq[:, :-1] = np.round(np.asarray(curr_ped_seq[:, :-1], dtype=float), decimals=4)
-                    pad_front = frames.index(curr_ped_seq[0, 0]) - idx
-                    pad_end = frames.index(curr_ped_seq[-1, 0]) - idx + 1
-                    curr_ped_seq = np.transpose(curr_ped_seq[:, 2:])    # [[x_pos,...],[y_pos,...],['biker','biker'...]] 
-                    classEncoding = np.asarray(one_hot_encoding(label)[curr_ped_seq[-1][0]], dtype=float)
-                    curr_ped_seq = np.array(curr_ped_seq[:-1], dtype=float)  # position: [[x_pos,...],[y_pos,...]]
+                    ped_rows = curr_agent == ped_id
+                    ped_frames = curr_frame[ped_rows]
+                    pad_front = np.searchsorted(frames, ped_frames[0]) - idx
+                    pad_end = np.searchsorted(frames, ped_frames[-1]) - idx + 1
+                    classEncoding = np.asarray(class_encoding[scene.label_names[curr_label[ped_rows][0]]], dtype=float)
+                    curr_ped_seq = np.transpose(np.round(np.asarray(curr_coord[ped_rows], dtype=float), decimals=4))  # position: [[x_pos,...],[y_pos,...]]
 
                     curr_ped_seq = curr_ped_seq/sf
                     if ((curr_ped_seq.shape[1] != self.seq_len) or (pad_end - pad_front != self.seq_len)): # if the seq_len != 20, ignore
@@ -234,18 +417,28 @@ class TrajectoryDataset(Dataset):
                     curr_loss_mask[_idx, pad_front:pad_end] = 1
                     num_peds_considered += 1
                 if num_peds_considered > min_ped:
-                    non_linear_ped += _non_linear_ped
-                    num_peds_in_seq.append(num_peds_considered) 
-                    loss_mask_list.append(curr_loss_mask[:num_peds_considered])
-                    seq_list.append(curr_seq[:num_peds_considered])   # seq_list: e.g. [[16,2,20],[7,2,20]...] #nodes are different for each seq
-                    seq_list_rel.append(curr_seq_rel[:num_peds_considered])
-                    seq_list_class.append(curr_seq_class[:num_peds_considered])
+                    if max_nodes is not None and num_peds_considered > max_nodes:
+                        # split crowded sequences by the positions at the last observed step
+                        tiles = spatial_tiles(curr_seq[:num_peds_considered, :, self.obs_len - 1], max_nodes,
+                                              tile_mode, tile_halo, min_ped + 1)
+                    else:
+                        tiles = [(np.arange(num_peds_considered), np.ones(num_peds_considered, dtype=bool))]
+                    _non_linear_ped = np.asarray(_non_linear_ped)
+                    for node_idx, core in tiles:
+                        non_linear_ped += _non_linear_ped[node_idx].tolist()
+                        num_peds_in_seq.append(len(node_idx))
+                        loss_mask_list.append(curr_loss_mask[node_idx])
+                        seq_list.append(curr_seq[node_idx])   # seq_list: e.g. [[16,2,20],[7,2,20]...] #nodes are different for each seq
+                        seq_list_rel.append(curr_seq_rel[node_idx])
+                        seq_list_class.append(curr_seq_class[node_idx])
+                        core_mask_list.append(core)
         self.num_seq = len(seq_list)
         if not (np.array_equal(seq_list, [])):
             seq_list = np.concatenate(seq_list, axis=0) # concate all seq
             seq_list_rel = np.concatenate(seq_list_rel, axis=0)
             seq_list_class = np.concatenate(seq_list_class, axis=0) 
             loss_mask_list = np.concatenate(loss_mask_list, axis=0) 
+            core_mask_list = np.concatenate(core_mask_list, axis=0)
             non_linear_ped = np.asarray(non_linear_ped)
             # Convert numpy -> Torch Tensor
             self.obs_classes = torch.tensor(np.stack(seq_list_class)).type(torch.float)
@@ -258,6 +451,7 @@ class TrajectoryDataset(Dataset):
             self.pred_traj_rel = torch.from_numpy(
                 seq_list_rel[:, :, self.obs_len:]).type(torch.float)
             self.loss_mask = torch.from_numpy(loss_mask_list).type(torch.float)
+            self.core_mask = torch.from_numpy(core_mask_list)
             self.non_linear_ped = torch.from_numpy(non_linear_ped).type(torch.float) 
             cum_start_idx = [0] + np.cumsum(num_peds_in_seq).tolist()
             self.seq_start_end = [
@@ -271,10 +465,35 @@ class TrajectoryDataset(Dataset):
             self.A_pred = []
             print("Processing Data .....")
             pbar = tqdm(total=len(self.seq_start_end)) 
+            if adjacency != 'distance':
+                skeleton = skeleton_adjacency(label, skeleton_edges)
+                # one_hot_encoding puts label[i] at position len(label) - 1 - i
+                joint_idx = len(label) - 1 - torch.argmax(self.obs_classes, dim=1).numpy()
+                # the fixed adjacency is computed once per joint order and shared by all sequences
+                fixed_graphs = {}
             for ss in range(len(self.seq_start_end)): 
                 pbar.update(1)
 
                 start, end = self.seq_start_end[ss]
+                if adjacency != 'distance':
+                    joints = joint_idx[start:end]
+                    self.v_obs.append(self.obs_traj_rel[start:end].permute(2, 0, 1))
+                    self.v_pred.append(self.pred_traj_rel[start:end].permute(2, 0, 1))
+                    if adjacency == 'skeleton_blend':
+                        self.A_obs.append(seq_to_skeleton_graph(self.obs_traj_rel[start:end], skeleton[np.ix_(joints, joints)],
+                                                                skeleton_blend, self.norm_lap_matr)[1])
+                        self.A_pred.append(seq_to_skeleton_graph(self.pred_traj_rel[start:end], skeleton[np.ix_(joints, joints)],
+                                                                 skeleton_blend, self.norm_lap_matr)[1])
+                        continue
+                    if joints.tobytes() not in fixed_graphs:
+                        a_ = skeleton[np.ix_(joints, joints)]
+                        if self.norm_lap_matr:
+                            a_ = normalized_laplacian(a_)
+                        fixed_graphs[joints.tobytes()] = torch.from_numpy(a_).type(torch.float)
+                    a_ = fixed_graphs[joints.tobytes()]
+                    self.A_obs.append(a_.expand(self.obs_len, len(joints), len(joints)))
+                    self.A_pred.append(a_.expand(self.pred_len, len(joints), len(joints)))
+                    continue
                 v_, a_ = seq_to_graph(self.obs_traj[start:end, :], self.obs_traj_rel[start:end, :], self.norm_lap_matr, node_dim=dim)
                 self.v_obs.append(v_.clone())
                 self.A_obs.append(a_.clone())
@@ -295,7 +514,218 @@ class TrajectoryDataset(Dataset):
             self.obs_traj_rel[start:end, :], self.pred_traj_rel[start:end, :], 
             self.non_linear_ped[start:end], self.loss_mask[start:end, :], 
             self.v_obs[index], self.A_obs[index],
-            self.v_pred[index], self.A_pred[index], self.obs_classes[start:end]
+            self.v_pred[index], self.A_pred[index], self.obs_classes[start:end],
+            self.core_mask[start:end]
 
         ]
         return out
+
+
+class TrajectoryBuild(object):
+    """Per-timestep node features and adjacency of every agent track, built once and shared by the windows of any horizon"""
+
+    def __init__(self, data_dir, delim='space', norm_lap_matr=True, label=None, dim=2, sf=10):
+        """
+        Args:
+        - data_dir: Directory containing dataset files, as for TrajectoryDataset
+        - delim: Delimiter in the dataset files
+        - norm_lap_matr: Normalize the adjacency of every window into its Laplacian
+        - label: All the label categories of the trajectory
+        - dim: 2D or 3D data
+        - sf: scaling factor for the dataset
+        """
+        self.data_dir = data_dir
+        self.norm_lap_matr = norm_lap_matr
+        self.label = label
+        self.dim = dim
+        self.class_encoding = one_hot_encoding(label)
+        self.scenes = []
+        for path in sorted(os.listdir(self.data_dir)):
+            path = os.path.join(self.data_dir, path)
+            print(path)
+            scene = load_scene(path, delim)
+            if len(scene.frame) == 0:
+                print(str(path) + " - No data in file")
+                continue
+            self.scenes.append(self._build_scene(scene, sf))
+
+    @staticmethod
+    def _build_scene(scene, sf):
+        """
+        Rows of the scene sorted by (frame, agent), with for every row the row of the same agent in the
+        previous frame, the number of consecutive frames the agent is present in up to the row, the
+        absolute and relative position, and per frame the inverse-distance matrix of its agents.
+        """
+        n_frames = len(scene.frame_ids)
+        frame_idx = np.repeat(np.arange(n_frames), np.diff(scene.frame_offsets))
+        agent = np.asarray(scene.agent, dtype=np.int64)
+        order = np.lexsort((agent, frame_idx))
+        # an agent with several rows in a frame is not a valid node in that frame
+        same = (frame_idx[order][1:] == frame_idx[order][:-1]) & (agent[order][1:] == agent[order][:-1])
+        dup = np.zeros(len(order), dtype=bool)
+        dup[1:] |= same
+        dup[:-1] |= same
+        rows = order[~dup]
+        frame_idx, agent = frame_idx[rows], agent[rows]
+        frame_offsets = np.searchsorted(frame_idx, np.arange(n_frames + 1))
+
+        by_agent = np.lexsort((frame_idx, agent))
+        cont = (agent[by_agent][1:] == agent[by_agent][:-1]) & (frame_idx[by_agent][1:] == frame_idx[by_agent][:-1] + 1)
+        prev_row = np.full(len(rows), -1, dtype=np.int64)
+        prev_row[by_agent[1:][cont]] = by_agent[:-1][cont]
+        run_start = np.maximum.accumulate(np.where(np.concatenate(([True], ~cont)), np.arange(len(rows)), 0))
+        streak = np.empty(len(rows), dtype=np.int64)
+        streak[by_agent] = np.arange(len(rows)) - run_start + 1
+
+        pos = np.round(np.asarray(scene.coord[rows], dtype=float), decimals=4) / sf
+        rel = np.zeros(pos.shape)
+        has_prev = prev_row >= 0
+        rel[has_prev] = pos[has_prev] - pos[prev_row[has_prev]]
+
+        rel32 = rel.astype(np.float32)
+        weights = [inverse_distance(rel32[frame_offsets[f]:frame_offsets[f + 1]]) for f in range(n_frames)]
+
+        return {'frame_offsets': frame_offsets, 'prev_row': prev_row, 'streak': streak, 'pos': pos, 'rel': rel,
+                'label': np.asarray(scene.label[rows]), 'label_names': scene.label_names, 'weights': weights}
+
+    def windows(self, obs_len=8, pred_len=8, skip=1, threshold=0.002, min_ped=1):
+        """
+        Windows of the given horizon over the shared build, see TrajectoryWindows.
+        """
+        return TrajectoryWindows(self, obs_len, pred_len, skip, threshold, min_ped)
+
+
+class TrajectoryWindows(Dataset):
+    """Dataloder for one (obs_len, pred_len, skip) horizon over a TrajectoryBuild"""
+
+    def __init__(self, build, obs_len=8, pred_len=8, skip=1, threshold=0.002, min_ped=1):
+        """
+        Windows hold only the node rows at their last frame; the sequences and graphs are sliced from
+        the build on access and match those of TrajectoryDataset with the same arguments.
+        Args:
+        - build: TrajectoryBuild the windows are sliced from
+        - obs_len: Number of time-steps in input trajectories
+        - pred_len: Number of time-steps in output trajectories
+        - skip: Number of frames to skip while making the dataset
+        - threshold: Minimum error to be considered for non linear traj
+        - min_ped: Minimum number of pedestrians that should be in a seqeunce
+        """
+        super(TrajectoryWindows, self).__init__()
+        self.build = build
+        self.obs_len = obs_len
+        self.pred_len = pred_len
+        self.skip = skip
+        self.seq_len = self.obs_len + self.pred_len
+        self.threshold = threshold
+
+        self.windows = []
+        for s, scene in enumerate(build.scenes):
+            frame_offsets = scene['frame_offsets']
+            for idx in range(0, len(frame_offsets) - self.seq_len, skip):
+                last = idx + self.seq_len - 1
+                # agents present in every frame of the window
+                nodes = np.flatnonzero(scene['streak'][frame_offsets[last]:frame_offsets[last + 1]] >= self.seq_len)
+                if len(nodes) > min_ped:
+                    self.windows.append((s, idx, nodes + frame_offsets[last]))
+        self.num_seq = len(self.windows)
+        cum_start_idx = [0] + np.cumsum([len(nodes) for _, _, nodes in self.windows]).tolist()
+        self.seq_start_end = [
+            (start, end)
+            for start, end in zip(cum_start_idx, cum_start_idx[1:])
+        ]
+
+    def _graph(self, scene, rows, idx):
+        A = np.stack([scene['weights'][idx + t][np.ix_(rows[t] - scene['frame_offsets'][idx + t],
+                                                         rows[t] - scene['frame_offsets'][idx + t])]
+                      for t in range(len(rows))])
+        if self.build.norm_lap_matr:
+            A = normalized_laplacian(A)
+        return torch.from_numpy(A).type(torch.float)
+
+    def __len__(self):
+        return self.num_seq
+
+    def __getitem__(self, index):
+        s, idx, last_rows = self.windows[index]
+        scene = self.build.scenes[s]
+        rows = [last_rows]
+        for _ in range(self.seq_len - 1):
+            rows.append(scene['prev_row'][rows[-1]])
+        rows = np.stack(rows[::-1])  # (seq_len, nodes)
+
+        seq = scene['pos'][rows].transpose(1, 2, 0)
+        seq_rel = scene['rel'][rows].transpose(1, 2, 0)
+        seq_rel[:, :, 0] = 0
+
+        # the first observed step has no velocity, its adjacency is the identity
+        A_first = np.eye(len(last_rows))[None]
+        if self.build.norm_lap_matr:
+            A_first = normalized_laplacian(A_first)
+        A_obs = torch.cat((torch.from_numpy(A_first).type(torch.float),
+                           self._graph(scene, rows[1:self.obs_len], idx + 1)))
+        A_pred = self._graph(scene, rows[self.obs_len:], idx + self.obs_len)
+
+        # poly_fit of every node at once
+        t = np.linspace(0, self.pred_len - 1, self.pred_len)
+        res = np.polyfit(t, np.concatenate((seq[:, 0, -self.pred_len:], seq[:, 1, -self.pred_len:])).T, 2, full=True)[1]
+        non_linear_ped = np.zeros(len(last_rows))
+        if len(res) > 0:
+            non_linear_ped = (res[:len(last_rows)] + res[len(last_rows):] >= self.threshold).astype(float)
+
+        classes = [self.build.class_encoding[scene['label_names'][code]] for code in scene['label'][rows[0]]]
+        seq = torch.from_numpy(seq).type(torch.float)
+        seq_rel = torch.from_numpy(seq_rel).type(torch.float)
+        out = [
+            seq[:, :, :self.obs_len], seq[:, :, self.obs_len:],
+            seq_rel[:, :, :self.obs_len], seq_rel[:, :, self.obs_len:],
+            torch.from_numpy(non_linear_ped).type(torch.float), torch.ones(len(last_rows), self.seq_len),
+            seq_rel[:, :, :self.obs_len].permute(2, 0, 1), A_obs,
+            seq_rel[:, :, self.obs_len:].permute(2, 0, 1), A_pred, torch.tensor(classes, dtype=torch.float),
+            torch.ones(len(last_rows), dtype=torch.bool)
+        ]
+        return out
+
+
+class BucketBatchSampler(Sampler):
+    """Batch sampler grouping sequences with the same number of nodes, so that every batch stacks into one (B, C, T, N) tensor"""
+
+    def __init__(self, dataset, batch_size, shuffle=True, drop_last=False, generator=None):
+        """
+        Args:
+        - dataset: Dataset with seq_start_end, e.g. TrajectoryDataset or TrajectoryWindows
+        - batch_size: Maximum number of sequences in a batch
+        - shuffle: Shuffle the sequences within every bucket and the order of the batches across buckets
+        - drop_last: Drop the last incomplete batch of every bucket
+        - generator: torch.Generator used for shuffling
+        """
+        super(BucketBatchSampler, self).__init__()
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+        self.buckets = defaultdict(list)
+        for index, (start, end) in enumerate(dataset.seq_start_end):
+            self.buckets[end - start].append(index)
+        self.buckets = [torch.tensor(indices) for _, indices in sorted(self.buckets.items())]
+
+    def __iter__(self):
+        generator = self.generator
+        if generator is None:
+            generator = torch.Generator()
+            generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+
+        batches = []
+        for indices in self.buckets:
+            if self.shuffle:
+                indices = indices[torch.randperm(len(indices), generator=generator)]
+            for batch in torch.split(indices, self.batch_size):
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch.tolist())
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(indices) // self.batch_size for indices in self.buckets)
+        return sum(int(math.ceil(len(indices) / self.batch_size)) for indices in self.buckets)
@@ -5,6 +5,7 @@ import os
 from torch import optim
 from torch.utils.data import DataLoader
 
+from src.inference import load_checkpoint
 from src.metrics import *
 from src.model import *
 from src.utils import *
@@ -24,7 +25,7 @@ def train(model, optimizer, trainingData, metrics, class_weights, labels):
         # Get data
         batch = [tensor.cuda() for tensor in batch]
         obs_traj, pred_traj_gt, obs_traj_rel, pred_traj_gt_rel, non_linear_ped, \
-        loss_mask, V_obs, A_obs, V_tr, A_tr, obs_classes = batch
+        loss_mask, V_obs, A_obs, V_tr, A_tr, obs_classes, core_mask = batch
         optimizer.zero_grad()
         # Forward
         V_obs_tmp = V_obs.permute(0, 3, 1, 2).contiguous() 
@@ -36,8 +37,12 @@ def train(model, optimizer, trainingData, metrics, class_weights, labels):
         A_tr = A_tr.squeeze()
         V_pred = V_pred.squeeze() # pred traj
 
+        # only the core nodes of a tile are predicted, its halo nodes are context
+        core = core_mask[0]
+        V_pred, V_tr, core_classes = V_pred[:, core], V_tr[:, core], obs_classes[0][core]
+
         if batch_count % args.batch_size != 0 and cnt != turn_point:
-            l = graph_loss(V_pred, V_tr, obs_classes[0], class_weights, labels)
+            l = graph_loss(V_pred, V_tr, core_classes, class_weights, labels)
             if is_fst_loss:
                 loss = l
                 is_fst_loss = False
@@ -57,6 +62,7 @@ def train(model, optimizer, trainingData, metrics, class_weights, labels):
     metrics['train_loss'].append(loss_batch / batch_count)
 
 
+@torch.no_grad()
 def valid(model, validationData, metrics, class_weights, labels):
     model.eval()
     loss_batch = 0
@@ -71,7 +77,7 @@ def valid(model, validationData, metrics, class_weights, labels):
         # Get data
         batch = [tensor.cuda() for tensor in batch]
         obs_traj, pred_traj_gt, obs_traj_rel, pred_traj_gt_rel, non_linear_ped, \
-        loss_mask, V_obs, A_obs, V_tr, A_tr, obs_classes = batch
+        loss_mask, V_obs, A_obs, V_tr, A_tr, obs_classes, core_mask = batch
 
         V_obs_tmp = V_obs.permute(0, 3, 1, 2).contiguous()
 
@@ -83,8 +89,11 @@ def valid(model, validationData, metrics, class_weights, labels):
         A_tr = A_tr.squeeze()
         V_pred = V_pred.squeeze()
 
+        core = core_mask[0]
+        V_pred, V_tr, core_classes = V_pred[:, core], V_tr[:, core], obs_classes[0][core]
+
         if batch_count % args.batch_size != 0 and cnt != turn_point:
-            l = graph_loss(V_pred, V_tr, obs_classes[0], class_weights, labels)
+            l = graph_loss(V_pred, V_tr, core_classes, class_weights, labels)
             if is_fst_loss:
                 loss = l
                 is_fst_loss = False
@@ -101,6 +110,88 @@ def valid(model, validationData, metrics, class_weights, labels):
     metrics['val_loss'].append(loss_batch / batch_count)
 
 
+def batch_loss(model, batch, class_weights, labels):
+    """
+    Mean loss of a batch of sequences with the same number of nodes, from one batched forward pass.
+    """
+    batch = [tensor.cuda() for tensor in batch]
+    obs_traj, pred_traj_gt, obs_traj_rel, pred_traj_gt_rel, non_linear_ped, \
+    loss_mask, V_obs, A_obs, V_tr, A_tr, obs_classes, core_mask = batch
+
+    V_obs_tmp = V_obs.permute(0, 3, 1, 2).contiguous()
+    V_pred, _ = model(V_obs_tmp, A_obs, obs_classes)
+    V_pred = V_pred.permute(0, 2, 3, 1).contiguous()
+
+    loss = 0
+    for b in range(V_pred.shape[0]):
+        core = core_mask[b]
+        loss = loss + graph_loss(V_pred[b][:, core], V_tr[b][:, core], obs_classes[b][core], class_weights, labels)
+    return loss / V_pred.shape[0]
+
+
+def train_bucketed(model, optimizer, trainingData, metrics, class_weights, labels):
+    model.train()
+    loss_batch = 0
+    for batch in trainingData:
+        optimizer.zero_grad()
+        loss = batch_loss(model, batch, class_weights, labels)
+        loss.backward()
+        optimizer.step()
+        loss_batch = loss.item() + loss_batch
+
+    metrics['train_loss'].append(loss_batch / len(trainingData))
+
+
+@torch.no_grad()
+def valid_bucketed(model, validationData, metrics, class_weights, labels):
+    model.eval()
+    loss_batch = 0
+    for batch in validationData:
+        loss_batch = batch_loss(model, batch, class_weights, labels).item() + loss_batch
+
+    metrics['val_loss'].append(loss_batch / len(validationData))
+
+
+@torch.inference_mode()
+def evaluate(model, evaluationData, labels, k, scaling_factor):
+    """
+    Best-of-k evaluation of the 2D bi-variant predictions: the predictions of all scenes are
+    collected and sampled together, so k samples cost a few batched tensor ops. The errors are
+    reported in the scene units, i.e. multiplied back by the scaling factor of the dataset.
+    """
+    model.eval()
+    preds, init_pos, targets, classes = [], [], [], []
+    for batch in evaluationData:
+        batch = [tensor.cuda() for tensor in batch]
+        obs_traj, pred_traj_gt, obs_traj_rel, pred_traj_gt_rel, non_linear_ped, \
+        loss_mask, V_obs, A_obs, V_tr, A_tr, obs_classes, core_mask = batch
+
+        V_obs_tmp = V_obs.permute(0, 3, 1, 2).contiguous()
+        V_pred, _ = model(V_obs_tmp, A_obs, obs_classes)
+        V_pred = V_pred.permute(0, 2, 3, 1).contiguous()
+
+        for b in range(V_pred.shape[0]):
+            core = core_mask[b]
+            preds.append(V_pred[b][:, core])
+            init_pos.append(obs_traj[b, core, :, -1])
+            targets.append(pred_traj_gt[b, core].permute(2, 0, 1))
+            classes.append(obs_classes[b][core])
+
+    min_ade, min_fde, valid = best_of_k(torch.cat(preds, 1), torch.cat(init_pos), torch.cat(targets, 1), k)
+    min_ade, min_fde = min_ade * scaling_factor, min_fde * scaling_factor
+    classes = torch.cat(classes)[valid]
+    print('*' * 30)
+    skipped = (~valid).sum().item()
+    if skipped:
+        print('Skipped', skipped, 'of', len(valid), 'nodes with non-finite predictions')
+    if not valid.any():
+        return
+    print('Best of', k, 'minADE:', min_ade.mean().item(), 'minFDE:', min_fde.mean().item())
+    class_ade = class_mean(min_ade, classes, labels)
+    class_fde = class_mean(min_fde, classes, labels)
+    for label in class_ade:
+        print(label, 'minADE:', class_ade[label], 'minFDE:', class_fde[label])
+
 
 def graph_loss(V_pred, V_target, obs_classes, class_weights, labels):
     if args.dataset == '2D':
@@ -135,30 +226,47 @@ def start_training(data_set, num_epochs=250):
         os.path.join(data_set, 'train'),
         obs_len=obs_seq_len,
         pred_len=pred_seq_len,
-        skip=1, norm_lap_matr=True, label=labels, dim=feature_dim, sf=scaling_factor)
+        skip=1, norm_lap_matr=True, label=labels, dim=feature_dim, sf=scaling_factor,
+        max_nodes=args.max_nodes, tile_mode=args.tile_mode, tile_halo=args.tile_halo,
+        adjacency=args.adjacency, skeleton_blend=args.skeleton_blend)
     print(dset_train)
-    loader_train = DataLoader(
-        dset_train,
-        batch_size=1,
-        shuffle=True,
-        num_workers=0)
+    if args.bucket_batches:
+        loader_train = DataLoader(
+            dset_train,
+            batch_sampler=BucketBatchSampler(dset_train, args.batch_size, shuffle=True),
+            num_workers=0)
+    else:
+        loader_train = DataLoader(
+            dset_train,
+            batch_size=1,
+            shuffle=True,
+            num_workers=0)
 
     dset_val = TrajectoryDataset(
         os.path.join(data_set, 'val'),
         obs_len=obs_seq_len,
         pred_len=pred_seq_len,
-        skip=1, norm_lap_matr=True, label=labels, dim=feature_dim, sf=scaling_factor)
-
-    loader_val = DataLoader(
-        dset_val,
-        batch_size=1,
-        shuffle=True,
-        num_workers=0)
+        skip=1, norm_lap_matr=True, label=labels, dim=feature_dim, sf=scaling_factor,
+        max_nodes=args.max_nodes, tile_mode=args.tile_mode, tile_halo=args.tile_halo,
+        adjacency=args.adjacency, skeleton_blend=args.skeleton_blend)
+
+    if args.bucket_batches:
+        loader_val = DataLoader(
+            dset_val,
+            batch_sampler=BucketBatchSampler(dset_val, args.batch_size, shuffle=False),
+            num_workers=0)
+    else:
+        loader_val = DataLoader(
+            dset_val,
+            batch_size=1,
+            shuffle=True,
+            num_workers=0)
 
 
     # Defining the model
-    model = label_gcnn(n_layer=args.n_layer, input_feat=feature_dim, output_feat=out_dim, seq_len=args.obs_seq_len, pred_seq_len=args.pred_seq_len,   
-                          kernel_size=args.kernel_size, hot_enc_length=len(labels)).cuda()
+    model_args = dict(n_layer=args.n_layer, input_feat=feature_dim, output_feat=out_dim, seq_len=args.obs_seq_len, pred_seq_len=args.pred_seq_len,
+                      kernel_size=args.kernel_size, hot_enc_length=len(labels))
+    model = label_gcnn(checkpoint_layers=args.checkpoint_layers, **model_args).cuda()
 
     # Training settings
     optimizer = optim.Adam(model.parameters(), lr=args.lr)
@@ -167,8 +275,12 @@ def start_training(data_set, num_epochs=250):
     metrics = {'train_loss': [], 'val_loss': []}
 
     for epoch in range(num_epochs):
-        train(model, optimizer, loader_train, metrics, class_weights, labels)
-        valid(model, loader_val, metrics, class_weights, labels)
+        if args.bucket_batches:
+            train_bucketed(model, optimizer, loader_train, metrics, class_weights, labels)
+            valid_bucketed(model, loader_val, metrics, class_weights, labels)
+        else:
+            train(model, optimizer, loader_train, metrics, class_weights, labels)
+            valid(model, loader_val, metrics, class_weights, labels)
 
         print('*' * 30)
         print('Epoch:', epoch)
@@ -176,6 +288,49 @@ def start_training(data_set, num_epochs=250):
             if len(v) > 0:
                 print(k, v[-1])
 
+    # saved before the evaluation, so a failing evaluation does not lose the trained model
+    if args.checkpoint is not None:
+        # everything predict_scenes.py needs to rebuild the model and its input graphs
+        torch.save({'model_args': model_args, 'state_dict': model.state_dict(), 'labels': labels,
+                    'scaling_factor': scaling_factor, 'adjacency': args.adjacency,
+                    'skeleton_blend': args.skeleton_blend, 'max_nodes': args.max_nodes,
+                    'tile_mode': args.tile_mode, 'tile_halo': args.tile_halo}, args.checkpoint)
+
+    if args.dataset == '2D':
+        evaluate(model, loader_val, labels, args.eval_k, scaling_factor)
+
+
+def start_evaluation(data_set):
+    """
+    Best-of-k evaluation of a model saved with --checkpoint on the validation set, without training.
+    """
+    print('*' * 30)
+    print("Evaluation initiating....")
+    print(args)
+
+    model, config = load_checkpoint(args.checkpoint, 'cuda')
+    dset_val = TrajectoryDataset(
+        os.path.join(data_set, 'val'),
+        obs_len=config['obs_len'],
+        pred_len=config['pred_len'],
+        skip=1, norm_lap_matr=True, label=config['labels'], dim=config['dim'], sf=config['scaling_factor'],
+        max_nodes=config['max_nodes'], tile_mode=config['tile_mode'], tile_halo=config['tile_halo'],
+        adjacency=config['adjacency'], skeleton_blend=config['skeleton_blend'])
+
+    if args.bucket_batches:
+        loader_val = DataLoader(
+            dset_val,
+            batch_sampler=BucketBatchSampler(dset_val, args.batch_size, shuffle=False),
+            num_workers=0)
+    else:
+        loader_val = DataLoader(
+            dset_val,
+            batch_size=1,
+            shuffle=False,
+            num_workers=0)
+
+    evaluate(model, loader_val, config['labels'], args.eval_k, config['scaling_factor'])
+
 
 if __name__ == '__main__':
 
@@ -184,21 +339,44 @@ if __name__ == '__main__':
     # Model specific parameters
     parser.add_argument('--n_layer', type=int, default=1, help='number of Label-GCN layers')
     parser.add_argument('--kernel_size', type=int, default=3, help='graph convolving kernel size')
+    parser.add_argument('--checkpoint_layers', type=str, default=None,
+                        help="'all' or comma separated Label-GCN layers to recompute in the backward pass to save memory")
 
     # Data specific paremeters
     parser.add_argument('--dataset', type=str, default='3D', help='2D traffic prediction or 3D skeleton prediciton')
     parser.add_argument('--obs_seq_len', type=int, default=8, help='length of the observed trajectory')
     parser.add_argument('--pred_seq_len', type=int, default=12, help='length of the trajectory to be predicted')
+    parser.add_argument('--max_nodes', type=int, default=None, help='split sequences with more nodes into spatial tiles')
+    parser.add_argument('--tile_mode', type=str, default='grid', help='grid or kmeans tiling of crowded sequences')
+    parser.add_argument('--tile_halo', type=float, default=1.0, help='radius of the context nodes added around each tile')
+    parser.add_argument('--adjacency', type=str, default='distance',
+                        help='distance, or skeleton / skeleton_blend for the fixed joint topology of the 3D dataset')
+    parser.add_argument('--skeleton_blend', type=float, default=0.5, help='weight of the distance term of the skeleton_blend adjacency')
 
     # Training specific parameters
     parser.add_argument('--batch_size', type=int, default=64, help='minibatch size')
     parser.add_argument('--lr', type=float, default=0.0001, help='learning rate')
+    parser.add_argument('--bucket_batches', action='store_true',
+                        help='batch sequences with the same number of nodes into one forward pass')
+    parser.add_argument('--checkpoint', type=str, default=None, help='path to save the trained model to')
+
+    # Evaluation specific parameters
+    parser.add_argument('--eval_k', type=int, default=20, help='number of samples for the best-of-k evaluation of 2D predictions')
+    parser.add_argument('--eval_only', action='store_true',
+                        help='only evaluate the model saved at --checkpoint on the validation set, without training')
 
     args = parser.parse_args()
-    
+    if args.eval_only and (args.dataset != '2D' or args.checkpoint is None):
+        parser.error('--eval_only evaluates 2D predictions and needs --checkpoint')
+    if args.checkpoint_layers not in (None, 'all'):
+        args.checkpoint_layers = [int(k) for k in args.checkpoint_layers.split(',')]
+
     if args.dataset == '2D':
         path = os.path.join('data', 'stanfordProcessed')
     elif args.dataset == '3D':
         path = os.path.join('data', 'cmuProcessed')
 
-    start_training(path, num_epochs=10)
+    if args.eval_only:
+        start_evaluation(path)
+    else:
+        start_training(path, num_epochs=10)